@@ -6,7 +6,7 @@ import scanpy as sc
 from anndata import AnnData
 from gssnng.smoothing import nn_smoothing
 from gssnng.util import error_checking
-from gssnng.score_funs import scorefun
+from gssnng.score_funs import scorefun, index_genesets, score_all_cells, CellData, BATCH_METHODS
 from gssnng.gene_sets import genesets_from_gmt, Genesets, genesets_from_decoupler_model
 from typing import Union
 from multiprocessing import Pool
@@ -295,10 +295,14 @@ def _proc_data(
         return(data_list)
 
     # building up the argument list for the parallel call of _score_all_cells_all_sets
+    # a single worker can run the batch kernel on numba threads, with more workers that
+    # would oversubscribe the cores. this process never starts numba's threading layer,
+    # which isn't fork safe, so later pools can still be forked from it
+    parallel_kernel = (cores == 1)
     arglist = []
     for smoothed_adata, groupname in data_list:
         arglist.append(
-            (smoothed_adata, gs_obj, score_method, method_params, noise_trials, ranked, groupname)
+            (smoothed_adata, gs_obj, score_method, method_params, noise_trials, ranked, groupname, parallel_kernel)
         )
     # how about lambda x: _score_all_cells_all_sets(x, gs_obj, score_method, method_params, noise_trials, ranked)
     # not sure if that works with parallel, due to pickling. might have to be a proper function
@@ -350,9 +354,16 @@ def _get_cell_data(
 
     if ranked:
         # for right now always ranking genes up #
-        df_noise['uprank'] = df_noise.iloc[:,0].rank(method='min', ascending=True)  # up or down
+        # ranks are whole numbers, and are taken before the counts are downcast so no ties are introduced
+        df_noise['uprank'] = df_noise.iloc[:,0].rank(method='min', ascending=True).astype(np.uint32)  # up or down
         df_noise['dnrank'] = np.max(df['uprank']) - df['uprank']
 
+    # scoring is memory bound, single precision halves the bytes moved per gene
+    df_noise['counts'] = df_noise['counts'].astype(np.float32)
+
+    # positions in adata.var, for matching against the indexed gene sets
+    df_noise['var_idx'] = gdx
+
     return(df_noise)
 
 
@@ -363,7 +374,8 @@ def _score_all_cells_all_sets(
         method_params: dict,
         noise_trials: int,
         ranked: bool,
-        group_name: str
+        group_name: str,
+        parallel_kernel: bool = False
         ) -> pd.DataFrame:
     """
     Process cells and score each with a list of gene sets and a method
@@ -375,19 +387,30 @@ def _score_all_cells_all_sets(
     :param noise_trials: number of noisy samples to create, integer
     :param ranked: whether the gene expression counts should be rank ordered
     :param group_name: group of cells currently being processed
+    :param parallel_kernel: score batch methods on numba threads, only when a single worker is used
 
     :return: list of list of gene set score dictionaries
     """
     print("running " + str(group_name))
 
+    # every cell in the group shares the same genes, resolve the gene sets once
+    gs_index = index_genesets(gene_set_obj, smoothed_adata.var.index)
+
+    if score_method in BATCH_METHODS:
+        # all cells and gene sets at once, over cells
+        results = score_all_cells(smoothed_adata.obsm['X_smooth'], gene_set_obj, gs_index, score_method, ranked,
+                                  parallel=parallel_kernel)
+        return(pd.DataFrame(results, index=smoothed_adata.obs.index))
+
     results_list = []
     barcodes = []
     for cell_ix in range(smoothed_adata.shape[0]):  # tqdm.trange(smoothed_adata.shape[0]):  # for each cell ID
         results = dict()
         df_cell = _get_cell_data(smoothed_adata, cell_ix, noise_trials, method_params, ranked)
+        cell = CellData(df_cell)  # shared by the cell's gene sets
         barcodes.append(smoothed_adata.obs.index[cell_ix])
-        for gs_i in gene_set_obj.set_list:  # for each gene set
-            results[gs_i.name] = scorefun(gs_i, df_cell, score_method, method_params, ranked)
+        for gs_i, gs_idx in zip(gene_set_obj.set_list, gs_index.positions):  # for each gene set
+            results[gs_i.name] = scorefun(gs_i, df_cell, score_method, method_params, ranked, gs_idx, cell)
         results_list.append(results)
     results_df = pd.DataFrame(results_list, index=barcodes)
     return(results_df)
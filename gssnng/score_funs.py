@@ -1,8 +1,15 @@
+import threading
 import numpy as np
 import pandas as pd
+from collections import namedtuple
+from scipy import sparse
 
 import gssnng.util as si
-import statsmodels.robust.scale
+from numba import njit, prange
+
+# reassociation lets LLVM vectorize the reductions below, while keeping
+# IEEE nan/inf semantics so empty gene sets still score as nan
+FASTMATH = {'reassoc', 'contract', 'arcp'}
 
 def summed_up(su):
     """
@@ -30,7 +37,7 @@ def median_score(su):
     :param score_up: is the rank up or down?  True or False
     """
     # normalise the score for the number of genes in the signature
-    cnts_med = np.median(su)
+    cnts_med = _median(su)
     return(cnts_med)
 
 
@@ -49,71 +56,261 @@ def average_score(su):
     return(cnts_mean)
 
 
-def mean_z(allexprvals, genesetvals):
+# consistency constant for a normal distribution, 1 / Phi^-1(3/4),
+# the same scaling statsmodels.robust.scale.mad applies by default
+_MAD_C = 1.482602218505602
+
+
+def _median(a, overwrite=False):
+    """
+    Median from a single partition. Same result as np.median, without its
+    fixed overhead, which dominates for gene set sized arrays.
+
+    :param a: 1-d numpy array of values
+    :param overwrite: partition a in place rather than a copy
+    """
+    n = a.shape[0]
+    if n == 0:
+        return(np.nan)
+    if a.dtype.kind in 'iub':
+        # np.median gives a float for integer input (ranks)
+        a = a.astype(np.float64)
+        overwrite = True
+
+    k = n // 2
+    if overwrite:
+        a.partition(k)
+        p = a
+    else:
+        p = np.partition(a, k)
+
+    # as np.median, any nan gives nan. nans sort last, so they end up in the upper half
+    if np.isnan(np.max(p[k:])):
+        return(np.nan)
+
+    # for even n the other middle value is the largest of the lower half
+    if n % 2 == 1:
+        return(p[k])
+    return(0.5 * (p[k] + np.max(p[0:k])))
+
+
+# per-thread work space for the centered values in _mad and robust_std,
+# so scoring doesn't allocate a new array for every cell and gene set
+_SCRATCH = threading.local()
+
+
+def _get_scratch(n):
+    """
+    A float64 work array of length n, grown as needed and reused between calls.
+    The contents are overwritten by the next caller.
+
+    :param n: the number of values needed
+    """
+    buf = getattr(_SCRATCH, 'buf', None)
+    if buf is None or buf.shape[0] < n:
+        buf = np.empty(max(n, 1024))
+        _SCRATCH.buf = buf
+    return(buf[0:n])
+
+
+def _abs_dev(a, center):
+    """
+    |a - center| written into the scratch array, see _get_scratch.
+
+    :param a: numpy array of values
+    :param center: value the absolute deviations are taken from
+    """
+    d = _get_scratch(a.shape[0])
+    np.subtract(a, center, out=d)
+    np.abs(d, out=d)
+    return(d)
+
+
+def _mad(a, center=None):
+    """
+    Median absolute deviation around the median, scaled to match the
+    standard deviation for normally distributed data.
+
+    :param a: numpy array of values
+    :param center: the median of a, if it's already known
+    """
+    m = _median(a) if center is None else center
+    return(_MAD_C * _median(_abs_dev(a, m), overwrite=True))
+
+
+CellStats = namedtuple('CellStats', ['mean', 'std', 'median', 'mad'])
+
+class CellData:
+    """ one cell's expression frame, with the summaries shared by all of its gene sets """
+
+    def __init__(self, x):
+        """
+        The summaries are worked out on first use and kept for the life of
+        this object, make a new one for each cell (or after changing x).
+
+        :param x: the gene expr data frame, columns are: counts, uprank, dnrank, var_idx
+        """
+        self.x = x
+        self.library_len = len(x.index)
+        self._stats = dict()
+        self._rankings = dict()
+        self._var_order = None
+
+    def stats(self, exprcol):
+        """
+        :param exprcol: the column containing values we'll compute on
+        :return: CellStats of the column, see cell_stats
+        """
+        if exprcol not in self._stats:
+            self._stats[exprcol] = cell_stats(self.x, exprcol)
+        return(self._stats[exprcol])
+
+    def ranking(self, exprcol, undirected):
+        """
+        :param exprcol: the column containing values we'll compute on
+        :param undirected: sort on the centered, absolute values instead
+        :return: pandas Index of genes, see _cell_ranking
+        """
+        key = (exprcol, undirected)
+        if key not in self._rankings:
+            self._rankings[key] = _cell_ranking(self.x, exprcol, undirected, self.library_len)
+        return(self._rankings[key])
+
+    def positions(self, gs_idx):
+        """
+        :param gs_idx: var positions of the gene set genes
+        :return: rows of x holding the gene set genes, see _cell_positions
+        """
+        if self._var_order is None:
+            self._var_order = np.argsort(self.x['var_idx'].to_numpy(), kind='stable')
+        return(_cell_positions(self.x, gs_idx, self._var_order))
+
+
+@njit(cache=True, fastmath=FASTMATH, error_model='numpy')
+def _mean_std_kernel(expr):
+    """
+    Mean and (population) standard deviation in a single Welford pass.
+
+    :param expr: contiguous float64 array, all expressed genes
+    """
+    n = expr.shape[0]
+    mean = 0.0
+    m2 = 0.0
+    for i in range(n):
+        delta = expr[i] - mean
+        mean += delta / (i + 1)
+        m2 += delta * (expr[i] - mean)
+    return mean, np.sqrt(m2 / n)
+
+
+def cell_stats(x, exprcol):
+    """
+    Summary stats of one expression column of a cell. These are the same
+    for every gene set, so CellData computes them once per cell.
+
+    :param x: the gene expr data frame, columns are: counts, uprank, dnrank
+    :param exprcol: the column containing values we'll compute on
+
+    :return: CellStats(mean, std, median, mad)
+    """
+    exprdat = np.ascontiguousarray(x[exprcol], dtype=np.float64)
+    vals_mean, vals_std = _mean_std_kernel(exprdat)
+    vals_med = _median(exprdat)
+    return(CellStats(mean=vals_mean,
+                     std=vals_std,
+                     median=vals_med,
+                     mad=_mad(exprdat, vals_med)))
+
+
+@njit(cache=True, fastmath=FASTMATH, error_model='numpy')
+def _mean_z_kernel(su, vals_mean, vals_std):
+    """
+    Mean absolute z score of the gene set values.
+
+    :param su: contiguous array, genes *IN* the gene set (float32 counts or uint32 ranks)
+    :param vals_mean: mean of all expressed genes
+    :param vals_std: standard deviation of all expressed genes
+    """
+    acc = 0.0
+    for i in range(su.shape[0]):
+        acc += abs(su[i] - vals_mean)
+    return acc / su.shape[0] / vals_std
+
+
+def mean_z(stats, su):
     """
     Average Z score
 
-    :param exprdat: the pandas data frame of ranks, all genes
-    :param su: the ranked list of genes *IN* the gene set
-    :param sig_len_up: the number of expressed genes matched in the set
-    :param norm_method: 'standard or theoretical' # from singscore
-    :param score_up: is the rank up or down?  True or False
+    :param stats: CellStats of all genes, see cell_stats
+    :param su: numpy array of values for the genes *IN* the gene set, see expr_format
     """
     # normalise the score for the number of genes in the signature
-    vals_mean = np.mean(allexprvals)
-    vals_std = np.std(allexprvals)
-    centered = [ (np.abs(x - vals_mean) / vals_std) for x in genesetvals ]
-    score = np.mean(centered)
+    score = _mean_z_kernel(su, stats.mean, stats.std)
     return(score)
 
 
-def robust_std(exprdat, su):
+def robust_std(stats, su):
     """
     Median of median standardized counts
 
-    :param exprdat: the pandas data frame of ranks, all genes
-    :param su: the ranked list of genes *IN* the gene set
-    :param sig_len_up: the number of expressed genes matched in the set
-    :param norm_method: 'standard or theoretical' # from singscore
-    :param score_up: is the rank up or down?  True or False
+    :param stats: CellStats of all genes, see cell_stats
+    :param su: numpy array of values for the genes *IN* the gene set, see expr_format
     """
-    # normalise the score for the number of genes in the signature
-    cnts_med = np.median(exprdat)
-    mad_su = statsmodels.robust.scale.mad(exprdat)
-    centered_cnts = [ (np.abs(x - cnts_med) / mad_su) for x in su ]
-    score = np.median(centered_cnts)
+    # median of the centered values, partitioned in place in the scratch array
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = _median(_abs_dev(su, stats.median), overwrite=True) / stats.mad
     return(score)
 
 
-def rank_biased_overlap(x, exprcol, gs, geneset_genes, limit):
+def _cell_ranking(x, exprcol, undirected, library_len):
+    """
+    The cell's genes sorted by decreasing value. The order doesn't depend on
+    the gene set, so CellData sorts it once per cell.
+
+    :param x: the pandas data frame of ranks, all genes
+    :param exprcol: the column containing values we'll compute on
+    :param undirected: sort on the centered, absolute values instead
+    :param library_len: number of genes in x
+
+    :return: pandas Index of genes
+    """
+    y = x[exprcol]
+    if undirected:
+        # center & absolute value ranks, in double precision so centering doesn't add ties
+        maxN = np.ceil(library_len/2.0)
+        y = np.abs(y.astype(np.float64) - maxN)
+    return(y.sort_values(ascending=False).index)
+
+
+def rank_biased_overlap(x, exprcol, gs, geneset_genes, limit, ranking=None):
     """
     Rank biased overlap method
 
     :param x: the pandas data frame of ranks, all genes
     :param su: the ranked list of genes *IN* the gene set
     :param gs: the gene set
+    :param ranking: the cell's genes already sorted, see CellData.ranking
     """
     rbo_score = 0.0
 
-    # if undirected, then sort based on centered values
-    if gs.mode == '?':
-        # center & absolute value ranks
-        maxN = np.ceil(len(x.index)/2.0)
-        x['undir'] = [ np.abs(xi - maxN) for xi in x[exprcol]]
-        exprcol = 'undir'
+    # genes sorted by value, if undirected then sorted on centered values
+    if ranking is None:
+        ranking = _cell_ranking(x, exprcol, gs.mode == '?', len(x.index))
 
-    # get sorted dataframe
-    x_sorted = x.sort_values(by=exprcol, ascending=False)
-    y = x_sorted[exprcol]
+    # the overlap at depth i is the number of gene set hits in the top i+1 genes,
+    # so one membership test over the top genes and a running sum cover every depth
+    hits = ranking[0:limit].isin(geneset_genes)
+    overlap = np.cumsum(hits)
+    rbo_score += np.sum(overlap)
 
-    for i in range(limit):
-        subset = set(y.index[0:(i+1)])
-        rbo_score += len(subset.intersection(geneset_genes))
+    # depths past the end of the ranking all see the full overlap
+    if 0 < len(overlap) < limit:
+        rbo_score += (limit - len(overlap)) * overlap[-1]
 
-    return( rbo_score )
+    return( float(rbo_score) )
 
 
-def singscore(x, su, sig_len, norm_method, gs):
+def singscore(x, su, sig_len, norm_method, gs, library_len=None):
     """
     The singscore method
 
@@ -123,18 +320,22 @@ def singscore(x, su, sig_len, norm_method, gs):
     :param norm_method: 'standard or theoretical' # from singscore
     :param score_up: is the rank up or down?  True or False
     :param gs: gene set object
+    :param library_len: number of genes in x, if already known
     """
+    if library_len is None:
+        library_len = len(x.index)
+
     # normalise the score for the number of genes in the signature
     if gs.mode == '?':
         # center & absolute value ranks
-        maxN = np.ceil(len(x.index)/2.0)
-        su = [ np.abs(xi - maxN) for xi in su]
+        maxN = np.ceil(library_len/2.0)
+        su = np.abs(su - maxN)
 
     mean_rank = np.mean(su)
     norm_up = si.normalisation(norm_method=norm_method,
                                gs_mode=gs.mode,
                                score=mean_rank,
-                               library_len=len(x.index),
+                               library_len=library_len,
                                sig_len=sig_len)
 
     if gs.mode != '?':
@@ -225,93 +426,223 @@ def geneset_overlap(su, threshold, geneset_len):
     :param treshold: the value compared to exprdat['counts']
     """
     if geneset_len > 0:
-        score = float(np.sum([x > threshold for x in su])) / float(geneset_len)
+        score = float(np.sum(su > threshold)) / float(geneset_len)
     else:
-        score = np.sum([x > threshold for x in su])
+        score = np.sum(su > threshold)
 
     return(score)
 
 
 
-def expr_format(x, exprcol, geneset_genes):
+# flat var positions of every gene set, see index_genesets
+BatchIndex = namedtuple('BatchIndex', ['up_idx', 'up_starts', 'up_sizes',
+                                       'dn_idx', 'dn_starts', 'dn_sizes'])
+
+# gene sets resolved against one var index. positions has one dict of
+# 'up' / 'dn' var positions per gene set, in gene_set_obj.set_list order
+GenesetIndex = namedtuple('GenesetIndex', ['var_index', 'positions', 'batch'])
+
+
+def index_genesets(gene_set_obj, var_index):
+    """
+    Resolve each gene set to integer positions in the var index, the gene
+    universe shared by every cell in a group. This is done once per group,
+    after which cells are matched to gene sets by position, see expr_format.
+    The positions are only valid for frames and matrices over this var index.
+
+    :param gene_set_obj: the gene sets class object
+    :param var_index: the gene names, adata.var.index
+
+    :return: GenesetIndex
+    """
+    positions = []
+    for gs in gene_set_obj.set_list:
+        gs_idx = dict()
+        for key in ['up', 'dn']:
+            genes = getattr(gs, 'genes_' + key, None)
+            if genes is not None:
+                idx = var_index.get_indexer(genes)
+                gs_idx[key] = idx[idx >= 0]
+        positions.append(gs_idx)
+
+    # the same positions laid end to end, one segment per gene set, for score_all_cells
+    batch = dict()
+    for key in ['up', 'dn']:
+        segments = [gs_idx.get(key, np.empty(0, dtype=np.intp)) for gs_idx in positions]
+        sizes = np.array([len(si) for si in segments], dtype=np.intp)
+        batch[key + '_idx'] = np.concatenate(segments) if segments else np.empty(0, dtype=np.intp)
+        batch[key + '_starts'] = np.cumsum(sizes) - sizes
+        batch[key + '_sizes'] = sizes
+    return(GenesetIndex(var_index=var_index, positions=positions, batch=BatchIndex(**batch)))
+
+
+def _cell_positions(x, gs_idx, var_order=None):
+    """
+    Rows of the cell frame holding the gene set genes.
+
+    :param x: the gene expr data frame, with a var_idx column
+    :param gs_idx: var positions of the gene set genes
+    :param var_order: argsort of x['var_idx'], if already known
+
+    :return: integer row positions, only for genes expressed in the cell
+    """
+    var_idx = x['var_idx'].to_numpy()
+    if var_order is None:
+        var_order = np.argsort(var_idx, kind='stable')
+
+    # genes past the last expressed position can't be in the cell
+    found = np.searchsorted(var_idx, gs_idx, sorter=var_order)
+    inside = found < len(var_order)
+    rows = var_order[found[inside]]
+    return(rows[var_idx[rows] == gs_idx[inside]])
+
+
+def expr_format(x, exprcol, geneset_genes, gs_idx=None, cell=None):
     """
     Prepare the cell's expression for scoring.
-    :param x: the gene expr data frame, columns are: counts, uprank, dnrank
+    :param x: the gene expr data frame, columns are: counts, uprank, dnrank, var_idx
     :param exprcol: the column containing values we'll compute on
     :param geneset_genes: genes in the gene set
+    :param gs_idx: optional var positions of the gene set genes, from index_genesets
+                   on the var index of the AnnData that x was taken from
+    :param cell: optional CellData of x, to reuse its sorted var positions
 
-    :return su: values for the genes *IN* the gene set, ranked or not
+    :return su: numpy array of values for the genes *IN* the gene set, ranked or not
     :return sig_len: the number of expressed genes matched in the set
     """
-    sig_len_up = len(geneset_genes)
-    su = []
-    for j in geneset_genes:
-        if j in x.index:
-            su.append(x[exprcol][j])
-        else:
-            sig_len_up = sig_len_up - 1
-    return( (su, sig_len_up) )
+    if (gs_idx is not None) and ('var_idx' in x.columns):
+        # integer matching against the positions resolved once per group
+        idx = _cell_positions(x, gs_idx) if cell is None else cell.positions(gs_idx)
+    else:
+        # the cell's gene index is already a hash table of gene -> position,
+        # so look up the whole gene set at once and gather the values in one go
+        idx = x.index.get_indexer(geneset_genes)
+        idx = idx[idx >= 0]
+    su = x[exprcol].to_numpy()[idx]
+    return( (su, len(idx)) )
+
 
 
+# adapters from method_selector to each scoring method. they all take
+# (gs, cell, exprcol, geneset_genes, su, sig_len, method_params), where cell is
+# the CellData being scored and su and sig_len come from expr_format, and pass
+# on the arguments their method uses
 
-def method_selector(gs, x, exprcol, geneset_genes, method, method_params):
+def _method_singscore(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
     """
-    :param gs: the gene set
-    :param x: the gene expr data frame
-    :param exprcol: the column containing values we'll compute on
-    :param geneset_genes: genes in the gene set
-    :param method: the method we'll call
-    :param method_params: dictionary of method parameters
-    :param barcode: cell barcode
+    singscore, with method_params['normalization'] and the cell's library length
+    """
+    return(singscore(cell.x[exprcol], su, sig_len, method_params['normalization'], gs,
+                     library_len=cell.library_len))
 
-    :return: dictionary of results
+
+def _method_robust_std(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    robust_std, against the cell's stats
     """
+    return(robust_std(cell.stats(exprcol), su))
+
 
-    (su, sig_len) = expr_format(x, exprcol, geneset_genes)
-    exprdat = x[exprcol]
+def _method_summed_up(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    summed_up, on the gene set values only
+    """
+    return(summed_up(su))
 
-    if method == 'singscore':
-        res0 = singscore(exprdat, su, sig_len, method_params['normalization'], gs)
 
-    elif method == 'robust_std':
-        res0 = robust_std(exprdat, su)
+def _method_median_score(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    median_score, on the gene set values only
+    """
+    return(median_score(su))
 
-    elif method == 'summed_up':
-        res0 = summed_up(su)
 
-    elif method == 'median_score':
-        res0 = median_score(su)
+def _method_average_score(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    average_score, on the gene set values only
+    """
+    return(average_score(su))
 
-    elif method == 'average_score':
-        res0 = average_score(su)
 
-    elif method == 'mean_z':
-        res0 = mean_z(exprdat, su)
+def _method_mean_z(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    mean_z, against the cell's stats
+    """
+    return(mean_z(cell.stats(exprcol), su))
 
-    elif method == 'rank_biased_overlap':
-        res0 = rank_biased_overlap(x, exprcol, gs, geneset_genes, method_params['rbo_depth'])
 
-    elif method == 'ssgsea':
-        #x, su, sig_len, omega, gene_set
-        res0 = ssgsea(exprdat, su, sig_len, method_params['omega'], geneset_genes)
+def _method_rank_biased_overlap(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    rank_biased_overlap, to depth method_params['rbo_depth'] in the cell's ranking
+    """
+    return(rank_biased_overlap(cell.x, exprcol, gs, geneset_genes, method_params['rbo_depth'],
+                               ranking=cell.ranking(exprcol, gs.mode == '?')))
 
-    elif method == 'geneset_overlap':
-        if ('fraction' in method_params) and (method_params['fraction'] == True):
-            res0 = geneset_overlap(su, method_params['threshold'], len(geneset_genes))
-        else:
-            res0 = geneset_overlap(su, method_params['threshold'], 0)
 
-    else:
+def _method_ssgsea(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    ssgsea, with weight method_params['omega']
+    """
+    return(ssgsea(cell.x[exprcol], su, sig_len, method_params['omega'], geneset_genes))
+
+
+def _method_geneset_overlap(gs, cell, exprcol, geneset_genes, su, sig_len, method_params):
+    """
+    geneset_overlap above method_params['threshold'], as a fraction of the
+    gene set size when method_params['fraction'] is True
+    """
+    if ('fraction' in method_params) and (method_params['fraction'] == True):
+        return(geneset_overlap(su, method_params['threshold'], len(geneset_genes)))
+    return(geneset_overlap(su, method_params['threshold'], 0))
+
+
+# scoring method name -> adapter
+_METHODS = {
+    'singscore': _method_singscore,
+    'robust_std': _method_robust_std,
+    'summed_up': _method_summed_up,
+    'median_score': _method_median_score,
+    'average_score': _method_average_score,
+    'mean_z': _method_mean_z,
+    'rank_biased_overlap': _method_rank_biased_overlap,
+    'ssgsea': _method_ssgsea,
+    'geneset_overlap': _method_geneset_overlap,
+}
+
+
+def method_selector(gs, x, exprcol, geneset_genes, method, method_params, gs_idx=None, cell=None):
+    """
+    :param gs: the gene set
+    :param x: the gene expr data frame
+    :param exprcol: the column containing values we'll compute on
+    :param geneset_genes: genes in the gene set
+    :param method: the method we'll call
+    :param method_params: dictionary of method parameters
+    :param gs_idx: optional var positions of geneset_genes, see expr_format
+    :param cell: CellData of x, shared by the cell's gene sets. made here if not given
+    :param barcode: cell barcode
+
+    :return: dictionary of results
+    """
+    fn = _METHODS.get(method)
+    if fn is None:
         return(np.nan)
 
-    return(res0)
+    if cell is None:
+        cell = CellData(x)
+
+    # su comes back as a numpy array, the scorers work on it as is
+    (su, sig_len) = expr_format(x, exprcol, geneset_genes, gs_idx, cell)
+    return(fn(gs, cell, exprcol, geneset_genes, su, sig_len, method_params))
 
 
 def scorefun(gs,
              x,
              method,
              method_params,
-             ranked):
+             ranked,
+             gs_idx=None,
+             cell=None):
     """
     given a ranked list, produce a score
 
@@ -320,42 +651,264 @@ def scorefun(gs,
     :param method: the method we'll call
     :param method_params: dictionary of method parameters
     :param ranked: ranked data? True | False
+    :param gs_idx: optional 'up' / 'dn' var positions of gs, an entry of
+                   index_genesets(...).positions for the AnnData x was taken from.
+                   without it the genes are looked up by name
+    :param cell: optional CellData(x), made once per cell and passed to each of its
+                 gene sets so the cell's stats and rankings are only worked out once
 
     :return a score
     """
 
-    try:
-        if (gs.mode == 'UP') and (ranked == False):
-            res0 = method_selector(gs, x, 'counts', gs.genes_up, method, method_params)
-
-        elif (gs.mode == 'DN') and (ranked == False):
-            res0 = method_selector(gs, x, 'counts', gs.genes_dn, method, method_params)
-
-        elif (gs.mode == 'BOTH') and (ranked == False):
-            res0_up = method_selector(gs, x, 'counts', gs.genes_up, method, method_params)
-            res0_dn = method_selector(gs, x, 'counts', gs.genes_dn, method, method_params)
-            res0 = (res0_up - res0_dn)
-
-        elif (gs.mode == '?') and (ranked == False):
-            res0 = method_selector(gs, x, 'counts', gs.genes_up, method, method_params)
+    # ranked down genes are scored on the flipped ranks, otherwise on the counts
+    upcol = 'uprank' if ranked else 'counts'
+    dncol = 'dnrank' if ranked else 'counts'
 
-        elif (gs.mode == 'UP') and (ranked == True):
-            res0 = method_selector(gs, x, 'uprank', gs.genes_up, method, method_params)
+    if cell is None:
+        cell = CellData(x)
+    up_idx = None if gs_idx is None else gs_idx.get('up')
+    dn_idx = None if gs_idx is None else gs_idx.get('dn')
 
-        elif (gs.mode == 'DN') and (ranked == True):
-            res0 = method_selector(gs, x, 'dnrank', gs.genes_dn, method, method_params)
+    try:
+        if gs.mode == 'DN':
+            res0 = method_selector(gs, x, dncol, gs.genes_dn, method, method_params, dn_idx, cell)
 
-        elif (gs.mode == 'BOTH') and (ranked == True):
-            res0_up = method_selector(gs, x, 'uprank', gs.genes_up , method, method_params)
-            res0_dn = method_selector(gs, x, 'dnrank', gs.genes_dn, method, method_params)
-            res0 = (res0_up + res0_dn)
+        elif gs.mode == 'BOTH':
+            res0_up = method_selector(gs, x, upcol, gs.genes_up, method, method_params, up_idx, cell)
+            res0_dn = method_selector(gs, x, dncol, gs.genes_dn, method, method_params, dn_idx, cell)
+            # with ranks the direction is already in dnrank, with counts it's subtracted
+            res0 = (res0_up + res0_dn) if ranked else (res0_up - res0_dn)
 
-        elif (gs.mode == '?') and (ranked == True):
-            res0 = method_selector(gs, x, 'uprank', gs.genes_up, method, method_params)
+        else:  # 'UP' and '?'
+            res0 = method_selector(gs, x, upcol, gs.genes_up, method, method_params, up_idx, cell)
 
     except ():
         #res1 = dict(barcode = barcode, name=gs.name, mode=gs.mode, score=np.nan, var=np.nan)
         res0 = np.nan
 
+    # counts are scored in single precision, but scores are reported in double
+    if isinstance(res0, np.float32):
+        res0 = np.float64(res0)
+
     return(res0)
 
+
+def _combine_directions(gene_set_obj, res_up, res_dn, ranked):
+    """
+    Put the up and down scores together according to each gene set's mode,
+    the same way scorefun does.
+
+    :param gene_set_obj: the gene sets class object
+    :param res_up: scores of the up genes, gene sets along the last axis
+    :param res_dn: scores of the down genes, gene sets along the last axis
+    :param ranked: ranked data? True | False
+
+    :return: dictionary of gene set name -> score(s)
+    """
+    results = dict()
+    for i, gs in enumerate(gene_set_obj.set_list):
+        if gs.mode == 'DN':
+            results[gs.name] = res_dn[..., i]
+        elif gs.mode == 'BOTH':
+            results[gs.name] = (res_up[..., i] + res_dn[..., i]) if ranked else (res_up[..., i] - res_dn[..., i])
+        else:  # 'UP' and '?'
+            results[gs.name] = res_up[..., i]
+    return(results)
+
+
+# methods that reduce to sums over the gene set, and can be scored with score_all_cells
+BATCH_METHODS = ['summed_up', 'average_score', 'mean_z']
+
+# the same methods as integer codes, for dispatch inside the numba kernels
+_BATCH_METHOD_IDS = {'summed_up': 0, 'average_score': 1, 'mean_z': 2}
+
+
+@njit(cache=True)
+def _min_ranks(vals):
+    """
+    Ranks of vals where ties get the lowest rank, as pandas rank(method='min').
+
+    :param vals: 1-d array of values
+    """
+    m = vals.shape[0]
+    order = np.argsort(vals, kind='mergesort')
+    ranks = np.empty(m)
+    i = 0
+    while i < m:
+        j = i
+        while (j + 1 < m) and (vals[order[j + 1]] == vals[order[i]]):
+            j += 1
+        for t in range(i, j + 1):
+            ranks[order[t]] = i + 1
+        i = j + 1
+    return ranks
+
+
+@njit(cache=True, fastmath=FASTMATH, error_model='numpy')
+def _score_segments(pos, vals, flat_idx, starts, sizes, vals_mean, vals_std, method_id, out):
+    """
+    Score one cell against all gene set segments, the genes are found by
+    binary search in the cell's sorted var positions.
+
+    :param pos: sorted var positions of the cell's expressed genes
+    :param vals: the cell's values, one per entry of pos
+    :param flat_idx: var positions of all gene sets, laid end to end
+    :param starts: start of each gene set in flat_idx
+    :param sizes: number of genes in each gene set
+    :param vals_mean: mean of the expressed values, for mean_z
+    :param vals_std: std of the expressed values, for mean_z
+    :param method_id: code from _BATCH_METHOD_IDS
+    :param out: array to write one score per gene set into
+    """
+    m = pos.shape[0]
+    for k in range(starts.shape[0]):
+        n = 0.0
+        s = 0.0
+        d = 0.0
+        for i in range(starts[k], starts[k] + sizes[k]):
+            j = np.searchsorted(pos, flat_idx[i])
+            if (j < m) and (pos[j] == flat_idx[i]):
+                n += 1.0
+                s += vals[j]
+                d += abs(vals[j] - vals_mean)
+        if method_id == 0:
+            out[k] = s
+        elif method_id == 1:
+            out[k] = s / n
+        else:
+            out[k] = d / n / vals_std
+
+
+@njit(cache=True, fastmath=FASTMATH, error_model='numpy')
+def _score_directions(pos, upvals, dnvals,
+                      up_idx, up_starts, up_sizes,
+                      dn_idx, dn_starts, dn_sizes,
+                      method_id, out_up, out_dn):
+    """
+    Score the up gene sets on upvals and the down gene sets on dnvals,
+    both indexed by the cell's sorted var positions pos.
+    """
+    # only mean_z needs the cell's mean and std, and counts use the same values both ways
+    up_mean, up_std = 0.0, 0.0
+    dn_mean, dn_std = 0.0, 0.0
+    if method_id == 2:
+        up_mean, up_std = _mean_std_kernel(upvals)
+        if upvals is dnvals:
+            dn_mean, dn_std = up_mean, up_std
+        else:
+            dn_mean, dn_std = _mean_std_kernel(dnvals)
+    _score_segments(pos, upvals, up_idx, up_starts, up_sizes, up_mean, up_std, method_id, out_up)
+    _score_segments(pos, dnvals, dn_idx, dn_starts, dn_sizes, dn_mean, dn_std, method_id, out_dn)
+
+
+@njit(cache=True, fastmath=FASTMATH, error_model='numpy')
+def _score_cell(indptr, indices, data, c,
+                up_idx, up_starts, up_sizes,
+                dn_idx, dn_starts, dn_sizes,
+                method_id, ranked, out_up, out_dn):
+    """
+    Score one cell (row c of a CSR matrix) against every gene set segment,
+    writing the up and down scores into out_up and out_dn.
+    """
+    # the row's column indices are the cell's sorted var positions
+    pos = indices[indptr[c]:indptr[c + 1]]
+    raw = data[indptr[c]:indptr[c + 1]]
+
+    if ranked:
+        upvals = _min_ranks(raw)
+        top = 0.0
+        for j in range(upvals.shape[0]):
+            top = max(top, upvals[j])
+        _score_directions(pos, upvals, top - upvals,
+                          up_idx, up_starts, up_sizes, dn_idx, dn_starts, dn_sizes,
+                          method_id, out_up, out_dn)
+    else:
+        # counts are gathered and reduced straight from the row, no per-cell copies
+        _score_directions(pos, raw, raw,
+                          up_idx, up_starts, up_sizes, dn_idx, dn_starts, dn_sizes,
+                          method_id, out_up, out_dn)
+
+
+@njit(parallel=True, cache=True, fastmath=FASTMATH, error_model='numpy')
+def _score_all_cells_parallel(indptr, indices, data,
+                              up_idx, up_starts, up_sizes,
+                              dn_idx, dn_starts, dn_sizes,
+                              method_id, ranked):
+    """
+    Score every cell of a CSR matrix, cells are independent and run in parallel.
+
+    :return: up and down scores, each cells x gene sets
+    """
+    n_cells = indptr.shape[0] - 1
+    res_up = np.zeros((n_cells, up_starts.shape[0]))
+    res_dn = np.zeros((n_cells, dn_starts.shape[0]))
+    for c in prange(n_cells):
+        _score_cell(indptr, indices, data, c,
+                    up_idx, up_starts, up_sizes, dn_idx, dn_starts, dn_sizes,
+                    method_id, ranked, res_up[c], res_dn[c])
+    return res_up, res_dn
+
+
+@njit(cache=True, fastmath=FASTMATH, error_model='numpy')
+def _score_all_cells_serial(indptr, indices, data,
+                            up_idx, up_starts, up_sizes,
+                            dn_idx, dn_starts, dn_sizes,
+                            method_id, ranked):
+    """
+    Score every cell of a CSR matrix one after another, without starting
+    numba's threading layer.
+
+    :return: up and down scores, each cells x gene sets
+    """
+    n_cells = indptr.shape[0] - 1
+    res_up = np.zeros((n_cells, up_starts.shape[0]))
+    res_dn = np.zeros((n_cells, dn_starts.shape[0]))
+    for c in range(n_cells):
+        _score_cell(indptr, indices, data, c,
+                    up_idx, up_starts, up_sizes, dn_idx, dn_starts, dn_sizes,
+                    method_id, ranked, res_up[c], res_dn[c])
+    return res_up, res_dn
+
+
+def score_all_cells(smoothed_matrix, gene_set_obj, gs_index, method, ranked, parallel=False):
+    """
+    Score every cell of a group against every gene set in one compiled pass
+    over the smoothed matrix, no per-cell data frames are built. Gives the
+    same scores as scorefun on each cell's _get_cell_data frame. Only for
+    BATCH_METHODS.
+
+    :param smoothed_matrix: cells x genes, the smoothed expression (adata.obsm['X_smooth'])
+    :param gene_set_obj: the gene sets class object
+    :param gs_index: index_genesets(gene_set_obj, adata.var.index) for the same AnnData
+    :param method: the method we'll call, one of BATCH_METHODS
+    :param ranked: ranked data? True | False
+    :param parallel: score the cells on numba threads. numba's threading layer isn't fork
+                     safe, so leave False in a process that goes on to fork a Pool
+
+    :return: dictionary of gene set name -> array of scores, one per cell
+    """
+    mat = sparse.csr_matrix(smoothed_matrix)
+    if mat.shape[1] != len(gs_index.var_index):
+        raise ValueError('ERROR: gene sets were indexed against ' + str(len(gs_index.var_index)) +
+                         ' genes, the matrix has ' + str(mat.shape[1]))
+    if (not mat.has_canonical_format) or np.any(mat.data == 0):
+        # sorted, summed entries, the kernel binary searches each cell's genes.
+        # explicit zeros aren't expressed, the same genes _get_cell_data keeps
+        mat = mat.copy()
+        mat.sum_duplicates()
+        mat.eliminate_zeros()
+
+    if ranked:
+        # ranks are taken on the full precision values
+        data = mat.data
+    else:
+        # counts are scored in single precision, as in _get_cell_data
+        data = mat.data.astype(np.float32)
+
+    batch = gs_index.batch
+    kernel = _score_all_cells_parallel if parallel else _score_all_cells_serial
+    (res_up, res_dn) = kernel(mat.indptr, mat.indices, data,
+                              batch.up_idx, batch.up_starts, batch.up_sizes,
+                              batch.dn_idx, batch.dn_starts, batch.dn_sizes,
+                              _BATCH_METHOD_IDS[method], bool(ranked))
+    return(_combine_directions(gene_set_obj, res_up, res_dn, ranked))
@@ -0,0 +1,260 @@
+import subprocess
+import sys
+import textwrap
+import numpy as np
+import pandas as pd
+from anndata import AnnData
+from scipy import sparse, stats
+from gssnng.gene_sets import Geneset, Genesets
+from gssnng.score_funs import _mad, _median, expr_format, index_genesets, cell_stats, robust_std
+from gssnng.score_funs import scorefun, score_all_cells, CellData, rank_biased_overlap, BATCH_METHODS
+from gssnng.score_cells import _get_cell_data
+
+
+def test_median_matches_numpy():
+    """
+    the partition based median should agree with np.median, for odd and even lengths
+    """
+    rng = np.random.default_rng(0)
+    for n in [1, 2, 3, 10, 101]:
+        a = rng.random(n)
+        np.testing.assert_allclose(_median(a), np.median(a))
+        ranks = rng.integers(1, 1000, size=n).astype(np.uint32)
+        np.testing.assert_allclose(_median(ranks), np.median(ranks))
+    assert np.isnan(_median(np.empty(0)))
+    for a in [[1.0, np.nan, 3.0], [np.nan, 2.0], [5.0, 1.0, 2.0, np.nan]]:
+        assert np.isnan(_median(np.array(a)))
+        assert np.isnan(_median(np.array(a), overwrite=True))
+
+
+def test_mad_matches_normal_scaled_mad():
+    """
+    the inlined MAD should agree with the normal-consistent MAD from scipy
+    (the same scaling statsmodels.robust.scale.mad uses)
+    """
+    rng = np.random.default_rng(42)
+    for n in [1, 2, 7, 50, 501]:
+        a = rng.gamma(2.0, 3.0, size=n)
+        np.testing.assert_allclose(_mad(a), stats.median_abs_deviation(a, scale='normal'))
+    assert np.isnan(_mad(np.array([1.0, np.nan, 3.0])))
+
+
+def test_robust_std_matches_median_of_centered_values():
+    """
+    robust_std should agree with the median of |su - median| / mad over the
+    cell's values, for counts and uint32 ranks, with gene sets of different
+    lengths scored one after another in the shared scratch array
+    """
+    rng = np.random.default_rng(13)
+    n = 1500  # more than the initial scratch size
+    x = pd.DataFrame({'counts': rng.gamma(2.0, 1.0, size=n).astype(np.float32)},
+                     index=['g' + str(i) for i in range(n)])
+    x['uprank'] = x['counts'].rank(method='min', ascending=True).astype(np.uint32)
+    x['dnrank'] = np.max(x['uprank']) - x['uprank']
+
+    for col in ['counts', 'uprank', 'dnrank']:
+        allvals = x[col].to_numpy().astype(np.float64)
+        cnts_med = np.median(allvals)
+        mad_su = stats.median_abs_deviation(allvals, scale='normal')
+        for size in [7, 2, 1200, 1, 50, 8]:
+            su = x[col].to_numpy()[rng.choice(n, size=size, replace=False)]
+            before = su.copy()
+            expected = np.median([ (np.abs(v - cnts_med) / mad_su) for v in su ])
+            np.testing.assert_allclose(robust_std(cell_stats(x, col), su), expected, rtol=1e-6)
+            np.testing.assert_array_equal(su, before)
+
+    assert np.isnan(robust_std(cell_stats(x, 'counts'), np.empty(0, dtype=np.float32)))
+
+
+def test_scorefun_scores_are_double():
+    """
+    counts are held in single precision, the scores should still come back as float64
+    """
+    rng = np.random.default_rng(17)
+    x = pd.DataFrame({'counts': rng.gamma(2.0, 1.0, size=30).astype(np.float32)},
+                     index=['g' + str(i) for i in range(30)])
+    genes = list(x.index)
+    for mode in ['UP', 'BOTH']:
+        gs = Geneset(name='gs', info='', gs_up=genes[0:10], gs_dn=genes[10:20], mode=mode)
+        for method, params in [('summed_up', {}), ('median_score', {}), ('average_score', {}),
+                               ('ssgsea', {'omega': 0.75})]:
+            assert isinstance(scorefun(gs, x, method, params, False), np.float64)
+
+
+def test_scorefun_sees_changes_to_the_frame():
+    """
+    scoring a frame that was changed in place should match scoring a fresh copy,
+    no stats or rankings are carried over between calls
+    """
+    rng = np.random.default_rng(19)
+    x = pd.DataFrame({'counts': rng.gamma(2.0, 1.0, size=30)}, index=['g' + str(i) for i in range(30)])
+    x['uprank'] = x['counts'].rank(method='min', ascending=True)
+    x['dnrank'] = np.max(x['uprank']) - x['uprank']
+    genes = list(x.index)
+    gs = Geneset(name='gs', info='', gs_up=genes[0:10], gs_dn=[], mode='UP')
+
+    for method, params in [('mean_z', {}), ('robust_std', {}), ('rank_biased_overlap', {'rbo_depth': 15})]:
+        scorefun(gs, x, method, params, False)
+        x['counts'] = rng.gamma(2.0, 1.0, size=30)
+        assert scorefun(gs, x, method, params, False) == scorefun(gs, x.copy(), method, params, False)
+
+        # one CellData shared by a cell's gene sets gives the same scores
+        cell = CellData(x)
+        assert scorefun(gs, x, method, params, False, cell=cell) == scorefun(gs, x, method, params, False)
+
+
+def test_expr_format_indexed_matches_lookup():
+    """
+    matching a cell against gene sets resolved to var positions should give
+    the same values as looking the genes up by name
+    """
+    var_index = pd.Index(['g' + str(i) for i in range(10)])
+    gdx = np.array([1, 2, 4, 5, 8])
+    x = pd.DataFrame({'counts': [1.0, 2.0, 4.0, 5.0, 8.0]}, index=var_index[gdx])
+    x['var_idx'] = gdx
+    gs = Geneset(name='gs', info='', gs_up=['g8', 'g0', 'g2', 'g2', 'nope'], gs_dn=[], mode='UP')
+    gs_index = index_genesets(Genesets([gs]), var_index)
+
+    su_lookup, len_lookup = expr_format(x, 'counts', gs.genes_up)
+    su_indexed, len_indexed = expr_format(x, 'counts', gs.genes_up, gs_index.positions[0]['up'])
+    np.testing.assert_array_equal(su_indexed, su_lookup)
+    np.testing.assert_array_equal(su_indexed, [8.0, 2.0, 2.0])
+    assert len_indexed == len_lookup == 3
+
+
+def test_indexing_leaves_gene_sets_unchanged():
+    """
+    indexing gene sets against one var order shouldn't change how they score
+    a cell taken from an AnnData with another var order
+    """
+    var_a = pd.Index(['g' + str(i) for i in range(10)])
+    var_b = var_a[::-1]
+    gdx = np.array([0, 3, 6, 9])
+    x = pd.DataFrame({'counts': [1.0, 2.0, 4.0, 8.0]}, index=var_b[gdx])
+    x['var_idx'] = gdx
+    gs = Geneset(name='gs', info='', gs_up=['g0', 'g3', 'g9'], gs_dn=[], mode='UP')
+
+    gs_index = index_genesets(Genesets([gs]), var_a)
+    assert scorefun(gs, x, 'summed_up', {}, False) == 13.0
+    assert scorefun(gs, x, 'summed_up', {}, False, index_genesets(Genesets([gs]), var_b).positions[0]) == 13.0
+    assert gs_index.positions[0]['up'].tolist() == [0, 3, 9]
+
+
+def _rbo_by_intersection(x, exprcol, gs, geneset_genes, limit):
+    """
+    rank biased overlap as originally written, one set intersection per depth
+    """
+    x = x.copy()
+    rbo_score = 0.0
+    if gs.mode == '?':
+        maxN = np.ceil(len(x.index)/2.0)
+        x['undir'] = [ np.abs(xi - maxN) for xi in x[exprcol]]
+        exprcol = 'undir'
+    y = x.sort_values(by=exprcol, ascending=False)[exprcol]
+    for i in range(limit):
+        subset = set(y.index[0:(i+1)])
+        rbo_score += len(subset.intersection(geneset_genes))
+    return(rbo_score)
+
+
+def test_rank_biased_overlap_matches_intersection_loop():
+    """
+    the running sum over the top genes should agree with intersecting the
+    gene set at every depth, including depths past the expressed genes and
+    the undirected ranking
+    """
+    rng = np.random.default_rng(11)
+    var_index = pd.Index(['g' + str(i) for i in range(40)])
+    gdx = np.sort(rng.choice(40, size=25, replace=False))
+    x = pd.DataFrame({'counts': rng.gamma(2.0, 1.0, size=25).astype(np.float32)}, index=var_index[gdx])
+    x['uprank'] = x['counts'].rank(method='min', ascending=True).astype(np.uint32)
+    x['dnrank'] = np.max(x['uprank']) - x['uprank']
+    x['var_idx'] = gdx
+
+    genes = list(var_index)
+    for mode in ['UP', '?']:
+        gs = Geneset(name='gs', info='', gs_up=genes[0:40:3] + ['nope'], gs_dn=[], mode=mode)
+        for exprcol in ['counts', 'uprank', 'dnrank']:
+            for limit in [0, 1, 10, 25, 60]:
+                np.testing.assert_allclose(
+                    rank_biased_overlap(x, exprcol, gs, gs.genes_up, limit),
+                    _rbo_by_intersection(x, exprcol, gs, gs.genes_up, limit))
+
+    # no expressed genes in the set, at any depth
+    gs = Geneset(name='gs', info='', gs_up=['nope'], gs_dn=[], mode='UP')
+    assert rank_biased_overlap(x, 'uprank', gs, gs.genes_up, 60) == 0.0
+
+
+def test_score_all_cells_matches_scorefun():
+    """
+    the batch kernel over the smoothed matrix should agree with scoring
+    each cell's data frame one gene set at a time
+    """
+    rng = np.random.default_rng(3)
+    X = rng.poisson(0.8, size=(12, 40)) * rng.random((12, 40))
+    X[:, 0] = 1.0  # ties, for the ranked case
+    adata = AnnData(X, var=pd.DataFrame(index=['g' + str(i) for i in range(40)]))
+    adata.obsm['X_smooth'] = X
+
+    genes = list(adata.var.index)
+    gene_set_obj = Genesets([
+        Geneset(name='up', info='', gs_up=genes[0:12] + ['nope'], gs_dn=[], mode='UP'),
+        Geneset(name='dn', info='', gs_up=[], gs_dn=genes[10:20], mode='DN'),
+        Geneset(name='both', info='', gs_up=genes[20:30], gs_dn=genes[30:40], mode='BOTH'),
+        Geneset(name='undirected', info='', gs_up=genes[5:35:2], gs_dn=[], mode='?'),
+        Geneset(name='missing', info='', gs_up=['nope'], gs_dn=[], mode='UP'),
+    ])
+    gs_index = index_genesets(gene_set_obj, adata.var.index)
+
+    # the same matrix with some explicit zeros stored, which aren't expressed genes
+    with_zeros = sparse.csr_matrix(X)
+    with_zeros.data[::7] = 0.0
+
+    for method in BATCH_METHODS:
+        for ranked in [False, True]:
+            all_cells = score_all_cells(adata.obsm['X_smooth'], gene_set_obj, gs_index, method, ranked)
+            stored = score_all_cells(with_zeros, gene_set_obj, gs_index, method, ranked)
+            dropped = score_all_cells(with_zeros.toarray(), gene_set_obj, gs_index, method, ranked)
+            for name in stored:
+                np.testing.assert_array_equal(stored[name], dropped[name])
+            for cell_ix in range(adata.shape[0]):
+                x = _get_cell_data(adata, cell_ix, 0, {}, ranked)
+                for gs, gs_idx in zip(gene_set_obj.set_list, gs_index.positions):
+                    np.testing.assert_allclose(all_cells[gs.name][cell_ix],
+                                               scorefun(gs, x, method, {}, ranked), rtol=1e-6)
+                    np.testing.assert_allclose(all_cells[gs.name][cell_ix],
+                                               scorefun(gs, x, method, {}, ranked, gs_idx), rtol=1e-6)
+
+
+def test_pool_workers_after_single_core_run():
+    """
+    a cores=1 run scores on numba threads in its worker, a following cores>1 run
+    forks more workers, after the same group was scored in this process. they
+    should agree, and the process should still exit. numba's threading layer
+    isn't fork safe, so this runs in a subprocess and a hang shows up as a timeout.
+    """
+    script = textwrap.dedent("""
+        import numpy as np
+        import pandas as pd
+        from anndata import AnnData
+        from gssnng.gene_sets import Geneset, Genesets
+        from gssnng.score_cells import _proc_data, _score_all_cells_all_sets
+
+        if __name__ == '__main__':
+            rng = np.random.default_rng(5)
+            X = rng.poisson(0.8, size=(20, 40)) * rng.random((20, 40))
+            adata = AnnData(X, obs=pd.DataFrame({'grp': ['a', 'b'] * 10}, index=['c' + str(i) for i in range(20)]),
+                            var=pd.DataFrame(index=['g' + str(i) for i in range(40)]))
+            genes = list(adata.var.index)
+            gs_obj = Genesets([Geneset(name='up', info='', gs_up=genes[0:12], gs_dn=[], mode='UP')])
+
+            adata.obsm['X_smooth'] = X
+            here = _score_all_cells_all_sets(adata, gs_obj, 'mean_z', dict(), 0, False, 'all')
+
+            one = _proc_data(adata, gs_obj, 'grp', 'off', 0, 'mean_z', dict(), 0, 0, False, 1, 0)
+            two = _proc_data(adata, gs_obj, 'grp', 'off', 0, 'mean_z', dict(), 0, 0, False, 2, 0)
+            pd.testing.assert_frame_equal(one.sort_index(), two.sort_index())
+            pd.testing.assert_frame_equal(one.sort_index(), here.sort_index())
+    """)
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
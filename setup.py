@@ -13,6 +13,6 @@ setup(name='gssnng',
       license='MIT',
       packages=['gssnng'],
       install_requires=[
-          'pandas', 'numpy', 'matplotlib', 'seaborn', 'scipy', 'statsmodels', 'scanpy', 'tqdm'
+          'pandas', 'numpy', 'numba', 'matplotlib', 'seaborn', 'scipy', 'scanpy', 'tqdm'
       ],
       zip_safe=False)